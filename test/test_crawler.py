@@ -1,20 +1,26 @@
 from unittest import TestCase
 import unittest
-from unittest.mock import MagicMock, Mock
-from crawler import build_request, recv_until_delimiter
+from crawler import (AsyncCrawler, FakebookSession, READ_BUFFER_SIZE, build_request, build_get, build_post, parse_response, get_cookie, recv_headers, recv_body,
+                     extract_links, extract_flag)
+import asyncio
 import socket
+import ssl
+import threading
 import gzip
+import io
+import zlib
+from unittest.mock import patch
 class Test(TestCase):
     def test_get_request(self):
         expected_request = (
-            "GET /test/path HTTP/1.1\r\n"
-            "Host: example.com\r\n"
-            "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
-            "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
-            "Accept-Language: en-US,en;q=0.5\r\n"
-            "Connection: keep-alive\r\n"
-            "Upgrade-Insecure-Requests: 1\r\n"
-            "TE: trailers\r\n\r\n"
+            b"GET /test/path HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
+            b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+            b"Accept-Language: en-US,en;q=0.5\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Upgrade-Insecure-Requests: 1\r\n"
+            b"TE: trailers\r\n\r\n"
         )
         result = build_request("GET", "/test/path", "example.com")
         self.assertEqual(result, expected_request)
@@ -23,70 +29,86 @@ class Test(TestCase):
         extra_headers = {"Content-Type": "application/x-www-form-urlencoded"}
         body = "key=value"
         expected_request = (
-            "POST /submit HTTP/1.1\r\n"
-            "Host: example.com\r\n"
-            "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
-            "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
-            "Accept-Language: en-US,en;q=0.5\r\n"
-            "Connection: keep-alive\r\n"
-            "Upgrade-Insecure-Requests: 1\r\n"
-            "TE: trailers\r\n"
-            "Content-Type: application/x-www-form-urlencoded\r\n"
-            "Content-Length: 9\r\n\r\n"
-            "key=value"
+            b"POST /submit HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
+            b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+            b"Accept-Language: en-US,en;q=0.5\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Upgrade-Insecure-Requests: 1\r\n"
+            b"TE: trailers\r\n"
+            b"Content-Type: application/x-www-form-urlencoded\r\n"
+            b"Content-Length: 9\r\n\r\n"
+            b"key=value"
         )
         self.assertEqual(build_request("POST", "/submit", "example.com", extra_headers, body), expected_request)
 
     def test_builds_request_with_additional_headers(self):
         extra_headers = {"X-Custom-Header": "CustomValue"}
         expected_request = (
-            "GET /path HTTP/1.1\r\n"
-            "Host: example.com\r\n"
-            "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
-            "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
-            "Accept-Language: en-US,en;q=0.5\r\n"
-            "Connection: keep-alive\r\n"
-            "Upgrade-Insecure-Requests: 1\r\n"
-            "TE: trailers\r\n"
-            "X-Custom-Header: CustomValue\r\n\r\n"
+            b"GET /path HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
+            b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+            b"Accept-Language: en-US,en;q=0.5\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Upgrade-Insecure-Requests: 1\r\n"
+            b"TE: trailers\r\n"
+            b"X-Custom-Header: CustomValue\r\n\r\n"
         )
         self.assertEqual(build_request("GET", "/path", "example.com", extra_headers), expected_request)
 
     def test_builds_request_with_empty_body(self):
         expected_request = (
-            "POST /submit HTTP/1.1\r\n"
-            "Host: example.com\r\n"
-            "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
-            "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
-            "Accept-Language: en-US,en;q=0.5\r\n"
-            "Connection: keep-alive\r\n"
-            "Upgrade-Insecure-Requests: 1\r\n"
-            "TE: trailers\r\n\r\n"
+            b"POST /submit HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0\r\n"
+            b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+            b"Accept-Language: en-US,en;q=0.5\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Upgrade-Insecure-Requests: 1\r\n"
+            b"TE: trailers\r\n\r\n"
         )
         self.assertEqual(build_request("POST", "/submit", "example.com"), expected_request)
 
+    def test_templates_match_build_request(self):
+        extras = "Cookie: csrftoken=a; sessionid=b\r\n"
+        self.assertEqual(build_get("/fakebook/", "example.com", extras),
+                         build_request("GET", "/fakebook/", "example.com", {"Cookie": "csrftoken=a; sessionid=b"}))
+        self.assertEqual(build_post("/submit", "example.com", "key=value", extras),
+                         build_request("POST", "/submit", "example.com", {"Cookie": "csrftoken=a; sessionid=b"}, "key=value"))
 
-class TestRecvUntilDelimiter(unittest.TestCase):
-    def test_recv_until_delimiter(self):
-        # Mock socket
-        mock_socket = Mock(spec=socket.socket)
+    def test_builds_other_methods(self):
+        self.assertTrue(build_request("HEAD", "/", "example.com").startswith(b"HEAD / HTTP/1.1\r\nHost: example.com\r\n"))
 
-        # Simulate receiving data in chunks
+
+class TestRecvFromSocket(unittest.TestCase):
+    @staticmethod
+    def recv_response(sock):
+        with sock.makefile("rb", buffering=READ_BUFFER_SIZE) as rf:
+            header_part = recv_headers(rf)
+            body = recv_body(rf, parse_response(header_part)["headers"])
+        return header_part + b"\r\n\r\n" + body
+
+    def test_recv_gzip_response(self):
+        server, client = socket.socketpair()
+
+        # Simulate the server sending the response and closing
         body = gzip.compress(b"Hello, world!")
-        mock_socket.recv = MagicMock(side_effect=[
-            b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n" + body + b""
-        ])
+        server.sendall(b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n" + body + b"")
+        server.close()
 
         # Expected result
         expected_result = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\nHello, world!"
 
         # Call the function
-        result = recv_until_delimiter(mock_socket)
+        result = self.recv_response(client)
+        client.close()
 
         # Assert the result
         self.assertEqual(expected_result, result)
 
-    def test_receive_until_delimiter_with_html(self):
+    def test_recv_gzip_html_response(self):
         with open("test_html.html", "rb") as file:
             html = file.read()
         compressed_html = gzip.compress(html)
@@ -96,19 +118,253 @@ class TestRecvUntilDelimiter(unittest.TestCase):
         #
         # gzipped_html = gzip.compress(html)
 
-        # Mock socket
-        mock_socket = Mock(spec=socket.socket)
+        server, client = socket.socketpair()
 
-        # Simulate receiving data in chunks
-        mock_socket.recv = MagicMock(side_effect=[
-            b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n" + compressed_html + b""
-        ])
+        # Simulate the server sending the response and closing
+        server.sendall(b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n" + compressed_html + b"")
+        server.close()
 
         # Expected result
         expected_result = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n\r\n" + gzip.decompress(compressed_html) + b""
 
         # Call the function
-        result = recv_until_delimiter(mock_socket)
+        result = self.recv_response(client)
+        client.close()
 
         # Assert the result
         self.assertEqual(expected_result, result)
+
+
+class TestParseResponse(unittest.TestCase):
+    def test_lowercases_headers_and_collects_cookies(self):
+        raw = (
+            b"HTTP/1.1 302 Found\r\n"
+            b"Location: /fakebook/\r\n"
+            b"Set-Cookie: csrftoken=abc; expires=Thu, 01 Jan 2026 00:00:00 GMT; Path=/\r\n"
+            b"Set-Cookie: sessionid=xyz; HttpOnly; Path=/\r\n\r\n"
+            b"body"
+        )
+        response = parse_response(raw)
+        self.assertEqual("HTTP/1.1 302 Found", response["status_line"])
+        self.assertEqual("/fakebook/", response["headers"]["location"])
+        self.assertEqual(b"body", response["body"])
+        self.assertEqual("abc", get_cookie(response["headers"], "csrftoken"))
+        self.assertEqual("xyz", get_cookie(response["headers"], "sessionid"))
+        self.assertEqual("", get_cookie(response["headers"], "missing"))
+
+
+class TestFramedRecv(unittest.TestCase):
+    def test_content_length_leaves_next_response_unread(self):
+        rf = io.BytesIO(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nHelloHTTP/1.1 302 Found\r\n")
+        header_part = recv_headers(rf)
+        self.assertEqual(b"HTTP/1.1 200 OK\r\nContent-Length: 5", header_part)
+        self.assertEqual(b"Hello", recv_body(rf, {"content-length": "5"}))
+        self.assertEqual(b"HTTP/1.1 302 Found\r\n", rf.read())
+
+    def test_chunked_gzip_body(self):
+        compressed = gzip.compress(b"Hello, world!")
+        chunked = b"%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n" % (5, compressed[:5], len(compressed) - 5, compressed[5:])
+        rf = io.BytesIO(chunked)
+        headers = {"transfer-encoding": "chunked", "content-encoding": "gzip"}
+        self.assertEqual(b"Hello, world!", recv_body(rf, headers))
+        self.assertEqual(b"", rf.read())
+
+    def test_deflate_and_identity_bodies(self):
+        compressed = zlib.compress(b"Hello, world!")
+        headers = {"content-encoding": "deflate", "content-length": str(len(compressed))}
+        self.assertEqual(b"Hello, world!", recv_body(io.BytesIO(compressed), headers))
+        self.assertEqual(b"Hello, world!", recv_body(io.BytesIO(b"Hello, world!"), {"content-length": "13"}))
+
+    def test_truncated_body_raises(self):
+        with self.assertRaises(ConnectionError):
+            recv_body(io.BytesIO(b"Hel"), {"content-length": "5"})
+
+    def test_truncated_headers_raise(self):
+        with self.assertRaises(ConnectionError):
+            recv_headers(io.BytesIO(b"HTTP/1.1 200 OK\r\nContent-Length: 12"))
+        with self.assertRaises(ConnectionError):
+            recv_headers(io.BytesIO(b"HTTP/1.1 200 OK\r\nContent-Length: 12\r\n"))
+        self.assertEqual(b"", recv_headers(io.BytesIO(b"")))
+
+
+class TestExtract(unittest.TestCase):
+    def test_extract_links_from_html(self):
+        with open("test_html.html", "rb") as file:
+            html = file.read()
+        links = extract_links(html)
+        self.assertIn(b"/fakebook/731770779/", links)
+        self.assertNotIn(b"/accounts/logout/", links)
+
+    def test_extract_flag(self):
+        html = b'<h3 class="secret_flag" style="color:red">FLAG: abc123</h3>'
+        self.assertTrue(extract_flag(html))
+        self.assertFalse(extract_flag(b"<h3>No flag here</h3>"))
+
+
+class TestFakebookSession(unittest.TestCase):
+    def test_follow_redirect_chain_on_one_connection(self):
+        server, client = socket.socketpair()
+        server.sendall(
+            b"HTTP/1.1 302 Found\r\nLocation: /next/\r\nContent-Length: 0\r\n\r\n"
+            b"HTTP/1.1 302 Found\r\nLocation: /fakebook/\r\n"
+            b"Set-Cookie: sessionid=xyz; HttpOnly; Path=/\r\nContent-Length: 0\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nhome"
+        )
+        session = FakebookSession("example.com", 443)
+        session.csrf_token = "abc"
+        session.secure_sock = client
+        session._reader = client.makefile("rb", buffering=READ_BUFFER_SIZE)
+        response = session.follow("/start/")
+        requests = server.recv(READ_BUFFER_SIZE)
+        session.close()
+        server.close()
+        self.assertEqual(b"home", response["body"])
+        self.assertEqual("xyz", session.session_id)
+        self.assertIn(b"GET /fakebook/ HTTP/1.1\r\n", requests)
+        self.assertIn(b"Cookie: csrftoken=abc; sessionid=xyz\r\n", requests)
+
+    def serve(self, scripts):
+        """
+        Starts a local server that answers the n-th connection with the
+        responses in scripts[n], one per request, then closes it.
+        Returns a session connected to it (over plain TCP), the serving
+        thread and the request lines received on each connection.
+        """
+        listener = socket.create_server(("127.0.0.1", 0))
+        requests = []
+
+        def serve():
+            for script in scripts:
+                conn, _ = listener.accept()
+                received = []
+                requests.append(received)
+                with conn, conn.makefile("rb") as rf:
+                    for response in script:
+                        received.append(recv_headers(rf).split(b"\r\n", 1)[0])
+                        conn.sendall(response)
+            listener.close()
+
+        class PlainSession(FakebookSession):
+            def connect(self):
+                self.secure_sock = socket.create_connection((self.server, self.port))
+                self._reader = self.secure_sock.makefile("rb", buffering=READ_BUFFER_SIZE)
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        return PlainSession("127.0.0.1", listener.getsockname()[1]), thread, requests
+
+    def test_fetch_retries_after_idle_close(self):
+        session, thread, requests = self.serve([
+            [b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nfirst"],
+            [b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nsecond"],
+        ])
+        with session:
+            self.assertEqual(b"first", session.fetch("GET", "/first/")["body"])
+            # The server closed the connection without saying so; the request is sent again.
+            self.assertEqual(b"second", session.fetch("GET", "/second/")["body"])
+        thread.join(5)
+        self.assertEqual([[b"GET /first/ HTTP/1.1"], [b"GET /second/ HTTP/1.1"]], requests)
+
+    def test_fetch_reconnects_after_connection_close(self):
+        session, thread, requests = self.serve([
+            [b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 5\r\n\r\nfirst"],
+            [b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nsecond",
+             b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nthird"],
+        ])
+        with session:
+            self.assertEqual(b"first", session.fetch("GET", "/first/")["body"])
+            self.assertEqual(b"second", session.fetch("GET", "/second/")["body"])
+            self.assertEqual(b"third", session.fetch("GET", "/third/")["body"])
+        thread.join(5)
+        self.assertEqual([[b"GET /first/ HTTP/1.1"], [b"GET /second/ HTTP/1.1", b"GET /third/ HTTP/1.1"]], requests)
+
+
+class TestAsyncCrawler(unittest.TestCase):
+    def crawl(self, pages, body, workers=1, failing_connects=()):
+        """
+        Runs an AsyncCrawler against a local server answering each path with
+        the next of its canned responses (repeating the last one). The
+        connect attempts numbered in failing_connects raise ssl.SSLError.
+        Returns the crawler, the requested paths and the number of connections.
+        """
+        requested = []
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            try:
+                while True:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                    path = head.split(b" ")[1].decode("ascii")
+                    requested.append(path)
+                    responses = pages[path]
+                    response = responses.pop(0) if len(responses) > 1 else responses[0]
+                    writer.write(response)
+                    await writer.drain()
+                    if b"Connection: close" in response:
+                        break
+            except asyncio.IncompleteReadError:
+                pass
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            crawler = AsyncCrawler("127.0.0.1", port, "user", "password", workers=workers)
+            attempts = []
+
+            async def connect():
+                attempts.append(None)
+                if len(attempts) - 1 in failing_connects:
+                    raise ssl.SSLError("handshake failed")
+                return await asyncio.open_connection("127.0.0.1", port)
+            crawler._connect = connect
+            try:
+                await asyncio.wait_for(crawler._crawl(body), 5)
+            finally:
+                server.close()
+            return crawler
+
+        with patch("crawler.RETRY_DELAY", 0):
+            crawler = asyncio.run(run())
+        return crawler, requested, len(connections)
+
+    @staticmethod
+    def page(*links, headers=b""):
+        html = b"".join(b'<a href="%s">x</a>' % link for link in links)
+        return b"HTTP/1.1 200 OK\r\n%sContent-Length: %d\r\n\r\n%s" % (headers, len(html), html)
+
+    def test_crawl(self):
+        pages = {
+            "/fakebook/1/": [self.page(b"/fakebook/2/", b"/fakebook/3/")],
+            "/fakebook/2/": [b"HTTP/1.1 302 Found\r\nLocation: /fakebook/4/\r\nContent-Length: 0\r\n\r\n"],
+            "/fakebook/3/": [b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n",
+                             self.page(b"/fakebook/1/", headers=b"Connection: close\r\n")],
+            "/fakebook/4/": [self.page()],
+        }
+        body = b'<a href="/fakebook/1/">x</a><a href="/fakebook/1/">x</a><a href="/fakebook/2/">x</a>'
+        # The reconnect after Connection: close fails once and is retried.
+        crawler, requested, connections = self.crawl(pages, body, failing_connects={1})
+        self.assertEqual(["/fakebook/1/", "/fakebook/2/", "/fakebook/3/", "/fakebook/3/", "/fakebook/4/"],
+                         sorted(requested))
+        self.assertEqual(1, crawler.retries["/fakebook/3/"])
+        # The worker reconnected after Connection: close.
+        self.assertEqual(2, connections)
+
+    def test_non_ascii_link_is_skipped(self):
+        pages = {
+            "/fakebook/1/": [self.page("/fakebook/\u00e9/".encode("utf-8"), b"/fakebook/2/")],
+            "/fakebook/2/": [self.page()],
+        }
+        _, requested, _ = self.crawl(pages, b'<a href="/fakebook/1/">x</a>')
+        self.assertEqual(["/fakebook/1/", "/fakebook/2/"], sorted(requested))
+
+    def test_crawl_survives_failed_connect(self):
+        pages = {"/fakebook/1/": [self.page()], "/fakebook/2/": [self.page()]}
+        body = b'<a href="/fakebook/1/">x</a><a href="/fakebook/2/">x</a>'
+        _, requested, _ = self.crawl(pages, body, workers=4, failing_connects={0, 1, 2})
+        self.assertEqual(["/fakebook/1/", "/fakebook/2/"], sorted(requested))
+
+    def test_failed_connect_of_every_worker_ends_crawl_with_error(self):
+        with self.assertRaises(ssl.SSLError):
+            self.crawl({}, b'<a href="/fakebook/1/">x</a>', workers=4, failing_connects={0, 1, 2, 3})